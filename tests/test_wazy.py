@@ -60,6 +60,13 @@ class TestUtils(unittest.TestCase):
         idx = wazy.resample(key, y, (3, 10))
         assert idx.shape == (3, 10)
 
+        # draws within a class should cover more than one example
+        y = np.repeat(np.arange(5.0), 10)
+        idx = np.asarray(wazy.resample(key, y, 2000, nclasses=5))
+        assert np.all((idx >= 0) & (idx < len(y)))
+        for c in range(5):
+            assert len(np.unique(idx[y[idx] == c])) > 1
+
 
 class TestMLP(unittest.TestCase):
     def setUp(self) -> None:
@@ -106,6 +113,28 @@ class TestMLP(unittest.TestCase):
         sparams = model.seq_t.init(key, s)
         model.seq_t.apply(sparams, key, s)
 
+    def test_ensemble_linear(self):
+        """Each member should match hk.Linear with that member's weights"""
+        key = jax.random.PRNGKey(0)
+        E, B, D, O = 5, 3, 7, 4
+        layer = hk.transform(lambda x: wazy.mlp.EnsembleLinear(O, E)(x))
+        linear = hk.transform(lambda x: hk.Linear(O)(x))
+        x3 = np.random.randn(E, B, D)
+        x2 = x3[:, 0]
+        params = layer.init(key, x3)
+        w = params["ensemble_linear"]["w"]
+        b = params["ensemble_linear"]["b"]
+        assert w.shape == (E, D, O)
+        assert b.shape == (E, O)
+        # give the bias a non-zero value
+        params = {"ensemble_linear": {"w": w, "b": np.random.randn(E, O)}}
+        for x in (x2, x3):
+            out = layer.apply(params, key, x)
+            assert out.shape == (*x.shape[:-1], O)
+            for i in range(E):
+                lp = {"linear": {"w": w[i], "b": params["ensemble_linear"]["b"][i]}}
+                assert np.allclose(out[i], linear.apply(lp, key, x[i]), atol=1e-5)
+
     def test_seq_grad(self):
         s = np.random.randn(10, 20)
         key = jax.random.PRNGKey(0)
@@ -153,6 +182,69 @@ class TestMLP(unittest.TestCase):
             key, model.train_t, c, self.reps, self.labels
         )
 
+    def test_deep_ensemble_loss(self):
+        """Loss is the Gaussian NLL with softplus variance"""
+        out = np.array([[[0.5, -1.0], [2.0, 0.3]], [[-1.0, 0.0], [0.1, 1.2]]])
+        labels = np.array([[1.0, 1.5], [0.0, -0.5]])
+        loss = wazy.mlp._deep_ensemble_loss(None, None, lambda *_: out, None, labels)
+        mu, var = out[..., 0], np.log1p(np.exp(out[..., 1])) + 1e-6
+        nll = 0.5 * np.log(2 * np.pi * var) + (labels - mu) ** 2 / (2 * var)
+        assert np.allclose(loss, np.sum(nll))
+        assert np.allclose(wazy.utils.transform_var(out[..., 1]), var)
+
+        # variance is floored at 1e-6 and grows linearly, so stays finite
+        out = np.array([[[0.0, 200.0], [0.0, -200.0]]])
+        loss = wazy.mlp._deep_ensemble_loss(
+            None, None, lambda *_: out, None, np.ones((1, 2))
+        )
+        assert np.isfinite(loss)
+        assert np.allclose(wazy.utils.transform_var(out[..., 1]), [200.0, 1e-6])
+
+    def test_train_padded_batches(self):
+        """Padded batches should not change params or the reported loss"""
+        key = jax.random.PRNGKey(0)
+        c = wazy.EnsembleBlockConfig(dropout=0)
+        model = wazy.EnsembleModel(c)
+        a = wazy.AlgConfig()
+        step = wazy.mlp.setup_ensemble_train(model.train_t, c, a)
+        x = np.random.randn(3, c.model_number, a.train_batch_size, 4)
+        y = np.random.randn(3, c.model_number, a.train_batch_size)
+
+        # 3 batches are padded to 4, fill the padding with junk
+        padded_x = wazy.mlp._pad_batches(x, 4)
+        padded_y = wazy.mlp._pad_batches(y, 4)
+        assert padded_x.shape[0] == 4
+        padded_x[3] = 100.0
+        padded_y[3] = 100.0
+
+        params = model.train_t.init(key, x[0])
+        hparams = wazy.mlp._TrainHParams.from_config(a)
+        opt_init = wazy.mlp._train_optimizer(hparams).init
+        keys = jax.random.split(key, 4)
+        copy = lambda t: jax.tree_util.tree_map(jnp.array, t)
+
+        _, p3, loss3 = step(
+            opt_init(params), copy(params), keys[:3], x, y, np.ones(3, dtype=bool)
+        )
+        _, p4, loss4 = step(
+            opt_init(params),
+            copy(params),
+            keys,
+            padded_x,
+            padded_y,
+            np.arange(4) < 3,
+        )
+        assert np.allclose(loss3, loss4)
+        jax.tree_util.tree_map(lambda u, v: np.testing.assert_allclose(u, v), p3, p4)
+
+        # exec path with a non power of two number of batches
+        labels = np.random.randn(3 * a.train_batch_size)
+        reps = np.random.randn(len(labels), 4)
+        params, losses = wazy.ensemble_train(
+            key, model.train_t, c, reps, labels, aconfig=wazy.AlgConfig(train_epochs=2)
+        )
+        assert np.all(np.isfinite(losses))
+
     def test_sine_train(self):
         """Fit to a sine wave and make sure regressed model is
         is within 2 stddev of label 95\% of the time
@@ -203,6 +295,16 @@ class TestMLP(unittest.TestCase):
         out = wazy.bayes_opt(key, forward, self.labels, init_x)
         # assert jnp.squeeze(final_vec).shape == (1900,)
 
+        # passing params in should match closing over them
+        g = wazy.mlp._batched_apply(model.infer_t.apply)
+        x = jax.random.normal(key, shape=(4, 1900))
+        x1, l1, _ = wazy.bayes_opt(
+            key, jax.vmap(forward, in_axes=(None, 0)), self.labels, x
+        )
+        x2, l2, _ = wazy.bayes_opt(key, g, self.labels, x, params=params)
+        assert np.allclose(x1, x2, atol=1e-5)
+        assert np.allclose(l1, l2, atol=1e-5)
+
     def test_alg_iter(self):
         key = jax.random.PRNGKey(0)
         c = wazy.EnsembleBlockConfig()
@@ -284,6 +386,36 @@ class TestAT(unittest.TestCase):
         boa.tell(key, "EEE", 0)
         x, _ = boa.ask(key)
 
+        # each acquisition function keeps its own compiled loop
+        boa.ask(key, aq_fxn="ei")
+        steps = dict(boa._bo_steps)
+        boa.ask(key, aq_fxn="ucb")
+        boa.ask(key, aq_fxn="ei")
+        assert len(boa._bo_steps) == 2
+        assert all(boa._bo_steps[k] is v for k, v in steps.items())
+
+        # after retraining, the cached loop scores with the new params,
+        # same as a loop closing over them
+        old_params = boa.params
+        boa.tell(key, "DDD", 2)
+        boa.ask(key, aq_fxn="ucb")
+        assert boa.params is not old_params
+        s = jax.random.normal(key, shape=(3, len(ALPHABET)))
+        sparams = boa.model.seq_t.init(key, s)
+        x0 = boa.model.random_seqs(key, boa.aconfig.bo_batch_size, sparams, 3)
+        labels = np.array(boa.labels, dtype=float)
+        step = boa._bo_steps[wazy.mlp.neg_bayesian_ucb]
+        _, l1, _ = wazy.mlp.exec_bayes_opt(
+            key, labels, x0, boa.aconfig, step, boa.params
+        )
+        g = jax.vmap(
+            functools.partial(boa.model.seq_apply, boa.params), in_axes=(None, 0)
+        )
+        _, l2, _ = wazy.bayes_opt(
+            key, g, labels, x0, wazy.mlp.neg_bayesian_ucb, boa.aconfig
+        )
+        assert np.allclose(l1, l2, atol=1e-5)
+
     def batch_ask(self):
         key = jax.random.PRNGKey(0)
         boa = wazy.BOAlgorithm(alg_config=wazy.AlgConfig(bo_epochs=10))
@@ -10,6 +10,7 @@ from .mlp import (
     alg_iter,
     neg_bayesian_ei,
     neg_bayesian_ucb,
+    neg_bayesian_max,
     AlgConfig,
 )
 from .seq import SeqpropBlock
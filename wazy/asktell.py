@@ -1,7 +1,6 @@
 import warnings
 import jax.numpy as jnp
 import numpy as np
-from functools import partial
 import jax
 from jax_unirep import get_reps
 from wazy.utils import ALPHABET
@@ -72,7 +71,7 @@ class BOAlgorithm:
         self._ready = False
         self._trained = 0
         self._train_step = None
-        self._bo_step = None
+        self._bo_steps = {}
         self._batch_decoder = None
 
     def _get_reps(self, seq):
@@ -153,17 +152,21 @@ class BOAlgorithm:
         x0 = self.model.random_seqs(
             key, self.aconfig.bo_batch_size, sparams, length, start_seq
         )
-        # make callable black-box function
-        g = jax.vmap(
-            partial(self.model.seq_apply, self.params),
-            in_axes=(None, 0),
-        )
         # do Bayes Opt and save best result only
         key, _ = jax.random.split(key)
-        if self._bo_step is None:
-            self._bo_step = setup_bayes_opt(g, aq, self.aconfig)
+        # current params are passed in, so one compiled loop per
+        # acquisition function is reused across rounds
+        if aq not in self._bo_steps:
+            # make callable black-box function
+            g = jax.vmap(self.model.seq_apply, in_axes=(None, None, 0))
+            self._bo_steps[aq] = setup_bayes_opt(g, aq, self.aconfig)
         batched_v, bo_loss, bo_key = exec_bayes_opt(
-            key, np.array(self.labels, dtype=float), x0, self.aconfig, self._bo_step
+            key,
+            np.array(self.labels, dtype=float),
+            x0,
+            self.aconfig,
+            self._bo_steps[aq],
+            self.params,
         )
         # find best result, not already measured
         seq = None
@@ -26,17 +26,15 @@ class EnsembleModel:
             return e(x, training)
 
         def model_forward(x, training=False):
-            x_dim = tuple([1 for i in range(x.ndim)])
-            s = jnp.tile(x, (config.model_number, *x_dim))
+            s = jnp.broadcast_to(x, (config.model_number, *x.shape))
             mean, var, epi_var = model_reduce(full_model_forward(s, training=training))
             return mean, var, epi_var
 
         def model_uncertainty_eval(x, training=False):
-            x_dim = tuple([1 for i in range(x.ndim)])
-            s = jnp.tile(x, (config.model_number, *x_dim))
+            s = jnp.broadcast_to(x, (config.model_number, *x.shape))
             out = full_model_forward(s, training=training)
             epistemic = jnp.std(out[..., 0], axis=0)
-            aleatoric = jnp.mean(jax.nn.softplus(out[..., 1]) + 1e-6, axis=0)
+            aleatoric = jnp.mean(transform_var(out[..., 1]), axis=0)
             return epistemic, aleatoric  # for each x[i]
 
         def seq_forward(x):  # params is trained mlp params
@@ -1,13 +1,9 @@
-from ast import Call
-from functools import partial
-from typing import Callable
-from wazy.seq import SeqpropBlock  # for use with vmap
+from functools import lru_cache, partial
 import jax
 import jax.numpy as jnp
 import haiku as hk
 import jax.scipy.stats.norm as norm
 import optax
-import haiku as hk
 from dataclasses import dataclass
 from .seq import *
 from .utils import resample
@@ -47,21 +43,29 @@ class AlgConfig:
     global_norm: float = 1
 
 
-class SingleBlock(hk.Module):
-    def __init__(self, config: EnsembleBlockConfig, name=None):
+class EnsembleLinear(hk.Module):
+    """Linear layer with separate weights for each ensemble member.
+
+    Weights are stored as one ``(model_number, in, out)`` array so all
+    members are applied with a single batched matmul.
+    """
+
+    def __init__(self, output_size: int, model_number: int, name=None):
         super().__init__(name=name)
-        self.config = config
+        self.output_size = output_size
+        self.model_number = model_number
 
-    def __call__(self, x, training):
-        key = hk.next_rng_key()
-        keys = jax.random.split(key, num=self.config.model_number)
-        for idx, dim in enumerate(self.config.shape):
-            x = hk.Linear(dim)(x)
-            if idx == 0 and training:
-                x = hk.dropout(keys[idx], self.config.dropout, x)
-            if idx < len(self.config.shape) - 1:
-                x = jax.nn.swish(x)
-        return x
+    # x is of shape ([model_number, ..., input_size])
+    def __call__(self, x):
+        input_size = x.shape[-1]
+        # same initialization as hk.Linear
+        w_init = hk.initializers.TruncatedNormal(1.0 / np.sqrt(input_size))
+        w = hk.get_parameter(
+            "w", (self.model_number, input_size, self.output_size), init=w_init
+        )
+        b = hk.get_parameter("b", (self.model_number, self.output_size), init=jnp.zeros)
+        b = b.reshape(self.model_number, *(1,) * (x.ndim - 2), self.output_size)
+        return jnp.einsum("e...i,eio->e...o", x, w) + b
 
 
 class EnsembleBlock(hk.Module):
@@ -71,13 +75,14 @@ class EnsembleBlock(hk.Module):
 
     # x is of shape ([ensemble_num, *seqs.shape])
     def __call__(self, x, training):
-        out = jnp.array(
-            [
-                SingleBlock(self.config)(x[i], training=training)
-                for i in range(self.config.model_number)
-            ]
-        )
-        return out
+        x = x[: self.config.model_number]
+        for idx, dim in enumerate(self.config.shape):
+            x = EnsembleLinear(dim, self.config.model_number)(x)
+            if idx == 0 and training:
+                x = hk.dropout(hk.next_rng_key(), self.config.dropout, x)
+            if idx < len(self.config.shape) - 1:
+                x = jax.nn.swish(x)
+        return x
 
 
 class NaiveBlock(hk.Module):
@@ -101,31 +106,23 @@ def _naive_loss(forward, params, key, x, y, epsilon=0.0):
 def _deep_ensemble_loss(params, key, forward, seqs, labels):
     out = forward(params, key, seqs)
     means = out[..., 0]
-    sstds = transform_var(out[..., 1])
+    var = transform_var(out[..., 1])
     n_log_likelihoods = (
-        0.5 * jnp.log(sstds)
-        + 0.5 * jnp.divide((labels - means) ** 2, sstds)
+        0.5 * jnp.log(var)
+        + 0.5 * (labels - means) ** 2 / var
         + 0.5 * jnp.log(2 * jnp.pi)
     )
     return jnp.sum(n_log_likelihoods)  # sum over batch and ensembles
 
 
-def _adv_loss_func(forward, M, params, key, seq_tile, label_tile, epsilon):
-    # first tile sequence/labels for each model
-    epsilon = epsilon
+def _adv_loss_func(forward, params, key, seq_tile, label_tile, epsilon):
     key1, key2 = jax.random.split(key)
-    grad_inputs = jax.grad(_deep_ensemble_loss, 3)(
-        params, key, forward, seq_tile, label_tile
+    # clean loss comes from the same forward pass as the input gradient
+    clean_loss, grad_inputs = jax.value_and_grad(_deep_ensemble_loss, 3)(
+        params, key1, forward, seq_tile, label_tile
     )
-
-    def _var(params, forward, seqs):
-        out = forward(params, key, seqs)
-        return jnp.sum(transform_var(out[..., 1]))
-
     seqs_ = seq_tile + epsilon * jnp.sign(grad_inputs)
-    return _deep_ensemble_loss(
-        params, key1, forward, seq_tile, label_tile
-    ) + _deep_ensemble_loss(params, key2, forward, seqs_, label_tile)
+    return clean_loss + _deep_ensemble_loss(params, key2, forward, seqs_, label_tile)
 
 
 def _shuffle(key, a, b):
@@ -133,7 +130,7 @@ def _shuffle(key, a, b):
     # something about shape of arrays makes shuffle not the same
     assert len(a) == len(b)
     p = jax.random.permutation(key, len(a))
-    return jnp.array([a[i] for i in p]), jnp.array([b[i] for i in p])
+    return a[p], b[p]
 
 
 def _fill_to_batch(x, y, key, batch_size):
@@ -145,52 +142,106 @@ def _fill_to_batch(x, y, key, batch_size):
     return x, y
 
 
+def _pad_batches(x, n):
+    pad = [(0, n - x.shape[0])] + [(0, 0)] * (x.ndim - 1)
+    return np.pad(x, pad)
+
+
+class _TrainHParams(NamedTuple):
+    """Hashable training hyperparameters, used to key the compiled epoch"""
+
+    adam_b1: float
+    adam_b2: float
+    adam_eps: float
+    weight_decay: float
+    lr: float
+    adv_loss_weight: float
+
+    @classmethod
+    def from_config(cls, aconfig: AlgConfig):
+        return cls(
+            aconfig.train_adam_b1,
+            aconfig.train_adam_b2,
+            aconfig.train_adam_eps,
+            aconfig.weight_decay,
+            aconfig.train_lr,
+            aconfig.train_adv_loss_weight,
+        )
+
+
+def _train_optimizer(hparams: _TrainHParams) -> optax.GradientTransformation:
+    return optax.chain(
+        optax.scale_by_adam(
+            b1=hparams.adam_b1,
+            b2=hparams.adam_b2,
+            eps=hparams.adam_eps,
+        ),
+        optax.add_decayed_weights(hparams.weight_decay),
+        optax.scale(-hparams.lr),  # minus sign -- minimizing the loss
+    )
+
+
+def _train_epoch(
+    forward, dual, hparams, opt_state, params, keys, batch_seqs, batch_labels, mask
+):
+    _, opt_update = _train_optimizer(hparams)
+    if dual == True:
+        loss_fxn = partial(_adv_loss_func, forward)
+    else:
+        loss_fxn = partial(_naive_loss, forward)
+    loss_and_grad = jax.value_and_grad(loss_fxn, 0)
+
+    def train_step(carry, batch):
+        key, seq, label, mask = batch
+
+        def update(carry):
+            opt_state, params = carry
+            s, l = _shuffle(key, seq, label)
+            loss, grad = loss_and_grad(params, key, s, l, hparams.adv_loss_weight)
+            updates, opt_state = opt_update(grad, opt_state, params)
+            params = optax.apply_updates(params, updates)
+            return (opt_state, params), loss
+
+        # padding batches leave the state untouched
+        return jax.lax.cond(mask, update, lambda c: (c, jnp.zeros(())), carry)
+
+    # one compiled loop over all batches of the epoch
+    (opt_state, params), losses = jax.lax.scan(
+        train_step, (opt_state, params), (keys, batch_seqs, batch_labels, mask)
+    )
+    return opt_state, params, jnp.sum(losses) / jnp.sum(mask)
+
+
+# compiled epoch is shared by every training run with the same model
+# and hyperparameters. opt_state and params are donated
+@lru_cache(maxsize=4)
+def _compiled_train_epoch(forward, dual, hparams):
+    return jax.jit(partial(_train_epoch, forward, dual, hparams), donate_argnums=(0, 1))
+
+
 def setup_ensemble_train(
     forward_t: hk.Transformed,
     mconfig: EnsembleBlockConfig,
     aconfig: AlgConfig = None,
     dual: bool = True,
-) -> Tuple[hk.Params, jnp.ndarray]:
+) -> Callable:
     """
-    Set-up ensemble training step
+    Set-up ensemble training epoch, which runs one optimizer step per batch
 
-    :param key: PRNG key
     :param forward_t: forward haiku transform
-    :param mconfig: model config
-    :param seqs: sequence data (featurized)
-    :param labels: label data
-    :param params: initial parameters
+    :param mconfig: model config, unused since the epoch does not
+        depend on it. Kept so existing callers still work
     :param aconfig: algorithm config
     :param dual: if True, model outputs aleatoric uncertainty
+    :return: compiled epoch, called as
+        ``train_step(opt_state, params, keys, batch_seqs, batch_labels, mask)``
+        and returning ``(opt_state, params, loss)``. ``opt_state`` and
+        ``params`` are donated
     """
     if aconfig is None:
         aconfig = AlgConfig()
-    opt_init, opt_update = optax.chain(
-        optax.scale_by_adam(
-            b1=aconfig.train_adam_b1,
-            b2=aconfig.train_adam_b2,
-            eps=aconfig.train_adam_eps,
-        ),
-        optax.add_decayed_weights(aconfig.weight_decay),
-        optax.scale(-aconfig.train_lr),  # minus sign -- minimizing the loss
-    )
-
-    if dual == True:
-        loss_fxn = partial(_adv_loss_func, forward_t.apply, mconfig.model_number)
-    else:
-        loss_fxn = partial(_naive_loss, forward_t.apply)
-
-    @jax.jit
-    def train_step(opt_state, params, key, seq, label):
-        seq, label = _shuffle(key, seq, label)
-        loss, grad = jax.value_and_grad(loss_fxn, 0)(
-            params, key, seq, label, aconfig.train_adv_loss_weight
-        )
-        updates, opt_state = opt_update(grad, opt_state, params)
-        params = optax.apply_updates(params, updates)
-        return opt_state, params, loss
-
-    return train_step
+    hparams = _TrainHParams.from_config(aconfig)
+    return _compiled_train_epoch(forward_t.apply, dual, hparams)
 
 
 def exec_ensemble_train(
@@ -213,19 +264,11 @@ def exec_ensemble_train(
     :param labels: label data
     :param params: initial parameters
     :param aconfig: algorithm config
-    :param dual: if True, model outputs aleatoric uncertainty
+    :param train_step: training epoch from :func:`setup_ensemble_train`
     """
     if aconfig is None:
         aconfig = AlgConfig()
-    opt_init, opt_update = optax.chain(
-        optax.scale_by_adam(
-            b1=aconfig.train_adam_b1,
-            b2=aconfig.train_adam_b2,
-            eps=aconfig.train_adam_eps,
-        ),
-        optax.add_decayed_weights(aconfig.weight_decay),
-        optax.scale(-aconfig.train_lr),  # minus sign -- minimizing the loss
-    )
+    opt_init = _train_optimizer(_TrainHParams.from_config(aconfig)).init
 
     # shape checks
     if seqs.shape[0] != labels.shape[0]:
@@ -253,17 +296,25 @@ def exec_ensemble_train(
 
     if params == None:
         params = forward_t.init(key, batch_seqs[0])
+    else:
+        # copy, since the training epoch donates its params buffers
+        params = jax.tree_util.tree_map(jnp.array, params)
+
+    # pad to a power of two batches, so the compiled epoch
+    # is reused as the dataset grows
+    padded_num = 2 ** int(np.ceil(np.log2(batch_num)))
+    batch_seqs = _pad_batches(batch_seqs, padded_num)
+    batch_labels = _pad_batches(batch_labels, padded_num)
+    mask = np.arange(padded_num) < batch_num
+
     opt_state = opt_init(params)
     losses = []
     for e in range(aconfig.train_epochs):
-        train_loss = 0.0
-        for b in range(batch_num):
-            key, tkey = jax.random.split(key, num=2)
-            opt_state, params, loss = train_step(
-                opt_state, params, tkey, batch_seqs[b], batch_labels[b]
-            )
-            train_loss += loss
-        train_loss /= batch_num
+        key, tkey = jax.random.split(key, num=2)
+        tkeys = jax.random.split(tkey, num=padded_num)
+        opt_state, params, train_loss = train_step(
+            opt_state, params, tkeys, batch_seqs, batch_labels, mask
+        )
         losses.append(train_loss)
     return (params, losses)
 
@@ -294,7 +345,8 @@ def neg_bayesian_ei(
 ) -> jnp.ndarray:
     joint_out = f(key, x)
     mu = joint_out[0]
-    std = jnp.sqrt(joint_out[1])
+    # variance can round below zero in model_reduce
+    std = jnp.sqrt(jnp.maximum(joint_out[1], 1e-16))
     z = (mu - best - xi) / std
     # we want to maximize, so neg!
     return -((mu - best - xi) * norm.cdf(z) + std * norm.pdf(z))
@@ -309,7 +361,8 @@ def neg_bayesian_ucb(
 ) -> jnp.ndarray:
     joint_out = f(key, x)
     mu = joint_out[0]
-    std = jnp.sqrt(joint_out[1])
+    # variance can round below zero in model_reduce
+    std = jnp.sqrt(jnp.maximum(joint_out[1], 1e-16))
     ucb = mu + beta * std
     return -ucb
 
@@ -326,49 +379,111 @@ def neg_bayesian_max(
     return -mu
 
 
-def setup_bayes_opt(f, cost_fxn=neg_bayesian_ucb, aconfig: AlgConfig = None):
-    if aconfig is None:
-        aconfig = AlgConfig()
-    optimizer = optax.adam(aconfig.bo_lr)
+def _bo_loop(f, cost_fxn, lr, params, x, keys, best, xi):
+    optimizer = optax.adam(lr)
+    # params are traced, so the same compiled loop serves every round
+    if params is not None:
+        f = partial(f, params)
 
-    # reduce it so we can take grad
-    reduced_cost_fxn = lambda *args: jnp.mean(cost_fxn(*args))
+    # reduce it so we can take grad.
+    # The non-reduced cost is kept as aux output
+    def reduced_cost_fxn(*args):
+        loss = cost_fxn(*args)
+        return jnp.mean(loss), loss
 
-    @jax.jit
-    def step(x, opt_state, key, best):
-        # reduced
-        g = jax.grad(reduced_cost_fxn, 2)(key, f, x, best, aconfig.bo_xi)
+    def step(carry, key):
+        x, opt_state = carry
+        g, loss = jax.grad(reduced_cost_fxn, 2, has_aux=True)(key, f, x, best, xi)
         updates, opt_state = optimizer.update(g, opt_state)
         x = optax.apply_updates(x, updates)
-        # non-reduced
-        loss = cost_fxn(key, f, x, best, aconfig.bo_xi)
-        return x, opt_state, loss
+        # loss is for x before this update
+        return (x, opt_state), loss
+
+    # all BO steps run in one compiled loop. best and xi are constant
+    # over the loop, so they are computed once by the caller
+    opt_state = optimizer.init(x)
+    (x, opt_state), losses = jax.lax.scan(step, (x, opt_state), keys)
+    # shift so losses[i] is the cost after step i, evaluating
+    # only the final point again
+    final_loss = cost_fxn(keys[-1], f, x, best, xi)
+    losses = jnp.concatenate((losses[1:], final_loss[None]))
+    return x, opt_state, losses
+
 
-    return step
+# compiled loop is reused per black-box function, acquisition and
+# learning rate, and specialized per input shape by jit. The cache is
+# small, since a loop through UniRep embeds its weights as constants.
+# Callers that hold on to many loops, like BOAlgorithm, keep their own
+@lru_cache(maxsize=4)
+def _compiled_bo_loop(f, cost_fxn, lr):
+    return jax.jit(partial(_bo_loop, f, cost_fxn, lr))
+
+
+def setup_bayes_opt(f, cost_fxn=neg_bayesian_ucb, aconfig: AlgConfig = None):
+    """
+    Set-up Bayes opt loop, which runs all ``bo_epochs`` steps in one
+    compiled call. Params are an argument of the loop, so one loop
+    serves every round of training
+
+    :param f: batched black-box function, called as ``f(key, x)``,
+        or ``f(params, key, x)`` if params are given at exec
+    :param cost_fxn: acquisition function
+    :param aconfig: algorithm config
+    :return: compiled loop, called as ``step(params, x, keys, best, xi)``
+        with one key per BO step, and returning ``(x, opt_state, losses)``
+    """
+    if aconfig is None:
+        aconfig = AlgConfig()
+    return _compiled_bo_loop(f, cost_fxn, aconfig.bo_lr)
+
+
+@lru_cache(maxsize=8)
+def _batched_apply(apply):
+    """Batch an apply(params, key, x) function over x, keeping one
+    wrapper per apply so compiled BO loops can be reused"""
+    return jax.vmap(apply, in_axes=(None, None, 0))
 
 
 def exec_bayes_opt(
-    key, labels, init_x, aconfig: AlgConfig = None, step: Callable = None
+    key,
+    labels,
+    init_x,
+    aconfig: AlgConfig = None,
+    step: Callable = None,
+    params: hk.Params = None,
 ):
+    """
+    Run Bayes opt loop
+
+    :param key: PRNG key
+    :param labels: measured labels, whose max is the current best
+    :param init_x: initial batch of inputs, one per restart
+    :param aconfig: algorithm config
+    :param step: compiled loop from :func:`setup_bayes_opt`
+    :param params: model params passed to the loop, if ``f`` takes them
+    :return: final ``x``, losses and the last key. Losses are one array
+        with a leading ``bo_epochs`` axis, where ``losses[i]`` is the cost
+        of each restart after step ``i``
+    """
     if aconfig is None:
         aconfig = AlgConfig()
-    optimizer = optax.adam(aconfig.bo_lr)
-    opt_state = optimizer.init(init_x)
-    x = init_x
-    losses = []
     best = np.max(labels)
     keys = jax.random.split(key, num=aconfig.bo_epochs)
-    for step_idx in range(aconfig.bo_epochs):
-        x, opt_state, loss = step(x, opt_state, keys[step_idx], best)
-        losses.append(loss)
-    return x, losses, keys[step_idx]
+    x, opt_state, losses = step(params, init_x, keys, best, aconfig.bo_xi)
+    return x, losses, keys[-1]
 
 
 def bayes_opt(
-    key, f, labels, init_x, cost_fxn=neg_bayesian_ucb, aconfig: AlgConfig = None
+    key,
+    f,
+    labels,
+    init_x,
+    cost_fxn=neg_bayesian_ucb,
+    aconfig: AlgConfig = None,
+    params: hk.Params = None,
 ):
     step = setup_bayes_opt(f, cost_fxn, aconfig)
-    return exec_bayes_opt(key, labels, init_x, aconfig, step)
+    return exec_bayes_opt(key, labels, init_x, aconfig, step, params)
 
 
 def alg_iter(
@@ -407,9 +522,9 @@ def alg_iter(
         call_infer = infer_t.apply
     except AttributeError:
         call_infer = infer_t
-    g = jax.vmap(partial(call_infer, params), in_axes=(None, 0))
+    g = _batched_apply(call_infer)
     # do Bayes Opt and save best result only
-    batched_v, bo_loss, _ = bayes_opt(bkey, g, y, init_x, cost_fxn, aconfig)
+    batched_v, bo_loss, _ = bayes_opt(bkey, g, y, init_x, cost_fxn, aconfig, params)
     """
     min_pos = jnp.argmin(jnp.array(
         [jnp.min(bo_loss[-1]), jnp.min(bo_loss_minus[-1]), jnp.min(bo_loss_plus[-1])]))
@@ -112,15 +112,18 @@ def resample(key, y, output_shape, nclasses=10):
         nclasses = y.shape[1]
     else:
         raise ValueError("y must rank 1 or 2")
-    uc = np.unique(classes)
+    uc, counts = np.unique(classes, return_counts=True)
     nclasses = uc.shape[0]
     if nclasses == 1:
         return jax.random.choice(key, np.arange(y.shape[0]), shape=output_shape)
-    idx = [np.where(classes == uc[i])[0] for i in range(nclasses)]
-    c = jax.random.choice(key, np.arange(nclasses), shape=output_shape)
-    keys = jax.random.split(key, nclasses)
-    f = np.vectorize(lambda i: jax.random.choice(keys[i], idx[i]))
-    return f(c)
+    # indices grouped by class, so class i occupies
+    # order[offsets[i]:offsets[i] + counts[i]]
+    order = np.argsort(classes, kind="stable")
+    offsets = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    ckey, ikey = jax.random.split(key)
+    c = jax.random.choice(ckey, np.arange(nclasses), shape=output_shape)
+    i = jax.random.randint(ikey, output_shape, 0, counts[c])
+    return order[offsets[c] + i]
 
 
 def transform_var(s):